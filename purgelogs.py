@@ -16,84 +16,234 @@
 
 import argparse
 import argparse
+import errno
 import logging
 import os
 import shutil
+import stat
 import sys
 
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
 from logging import Logger
 from pathlib import Path
-from typing import List, Generator, Optional, Tuple, Set
+from queue import Queue
+from typing import TYPE_CHECKING, List, Generator, Optional, Tuple, Union
 
-DirContent = Tuple[Set[Path], Set[str]]
+if TYPE_CHECKING:
+    DirEntry = os.DirEntry[str]
+else:
+    DirEntry = os.DirEntry
+Dir = Union[str, DirEntry]
+# Whether the directory is a jobdir, and its sub directories
+DirContent = Tuple[bool, List[DirEntry]]
+ScanResult = Tuple[Dir, Optional[float], List[DirEntry]]
+
+# Scanning is bound by getdents/stat latency, not by the GIL
+SCAN_WORKERS = 8
+# How many job dirs are queued for removal before waiting for them
+DELETE_BATCH_SIZE = 256
+
+# Entries that mark a zuul, jenkins or jenkins console jobdir
+JOBDIR_DIRS = frozenset(('zuul-info', 'ara-database'))
+JOBDIR_FILES = frozenset(('consoleText.txt', ))
+# Directories that never contain logs and are not walked
+SKIP_DIRS = frozenset(('.git', '.snapshots', 'lost+found'))
 
 def check_dir_path(log_path: str) -> Optional[Path]:
     """Ensures initial directory is valid"""
-    p = Path(log_path)
-    if not p.exists():
+    try:
+        mode = os.stat(log_path).st_mode
+    except OSError as e:
+        # Same errors as the ones Path.exists() reports as a missing path
+        if e.errno not in (errno.ENOENT, errno.ENOTDIR, errno.EBADF, errno.ELOOP):
+            raise
         return None
-    return p.resolve()
+    if not stat.S_ISDIR(mode):
+        return None
+    return Path(log_path).resolve()
 
 def delete_dir(dir_path: Path) -> None:
-    """Recursively deletes a path"""
+    """Recursively deletes a path
+
+    On Linux shutil.rmtree already walks the tree through open directory fds
+    (see shutil.rmtree.avoids_symlink_attacks), removing entries with unlinkat
+    relative to their parent instead of resolving full paths.
+    """
     shutil.rmtree(dir_path)
 
-def get_jobdir(dirs: Set[Path], files: Set[str]) -> bool:
-    """Check if directory content is a job dir"""
-    dirs_name = set(map(lambda s: s.name, dirs))
-    is_zuul = 'zuul-info' in dirs_name
-    is_jenkins = 'ara-database' in dirs_name
-    is_jenkins_console = 'consoleText.txt' in files
-    is_empty_dir = not files and not dirs
-
-    return is_zuul or is_jenkins or is_jenkins_console or is_empty_dir
-
-def ls(dir_path: Path) -> DirContent:
-    """Returns the aboluste list of directory and files in a directory, ignoring symlinks"""
-    dirs = set()
-    files = set()
-    for entry in os.listdir(dir_path):
-        entry_path = dir_path / entry
-        if not entry_path.is_symlink():
-            if entry_path.is_dir():
-                dirs.add(entry_path)
-            elif entry_path.exists():
-                files.add(entry)
-    return (dirs, files)
-
-def find_old_files(log: Logger, calculated_time: datetime, log_path: Path) -> Generator[Path, None, None]:
-    """Finds old files in the log path, stopping when a directory is a jobdir"""
-    queue = set((log_path, ))
-    while queue:
-        root = queue.pop()
-        current_dirs, current_files = ls(root)
-        if get_jobdir(current_dirs, current_files):
-            log.debug("%s : is a job dir", root)
-            dir_date = datetime.fromtimestamp(os.path.getmtime(root))
-            if dir_date < calculated_time:
-                yield root
-        else:
-            log.debug("%s : walking", root)
-            queue = queue.union(current_dirs)
-
-def search_and_destroy(log: Logger, calculated_time: datetime, dry_run: bool, log_path: Path) -> None:
-    """Removes log dir that are older than the calcultated time"""
-    for job_dir in find_old_files(log, calculated_time, log_path):
-        log.debug("%s : removing old logs", job_dir)
-        if not dry_run and log_path != job_dir:
-            delete_dir(job_dir)
+def get_mtime(dir_entry: Dir) -> float:
+    """Returns the modification time of a directory
+
+    A DirEntry keeps its stat result after the first call, so a sub directory already
+    stat'ed by the assume_monotonic_mtime prune is not stat'ed again.
+    """
+    if isinstance(dir_entry, str):
+        return os.stat(dir_entry).st_mtime
+    return dir_entry.stat(follow_symlinks=False).st_mtime
+
+def ls(dir_path: Dir) -> DirContent:
+    """Check if a directory is a job dir, else returns the list of its sub directories, ignoring symlinks
+
+    A job dir contains one of the JOBDIR_DIRS or JOBDIR_FILES, or is empty.
+    The SKIP_DIRS are not returned, but they still make their parent non empty.
+    """
+    dirs = []
+    is_empty = True
+    try:
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.is_symlink():
+                    continue
+                is_empty = False
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name in JOBDIR_DIRS:
+                        return (True, [])
+                    if entry.name not in SKIP_DIRS:
+                        dirs.append(entry)
+                elif entry.name in JOBDIR_FILES:
+                    return (True, [])
+    except FileNotFoundError:
+        # The directory vanished while walking the tree, there is nothing to purge
+        return (False, [])
+    return (is_empty, dirs)
+
+def scan(dir_entry: Dir, prune_newer_than: Optional[float]) -> ScanResult:
+    """Lists a directory, returning its mtime if it is a jobdir or else its sub directories to walk
+
+    When prune_newer_than is set, sub directories modified after that timestamp are not
+    returned: their content is assumed to be at least as recent.
+    """
+    is_jobdir, current_dirs = ls(dir_entry)
+    if is_jobdir:
+        try:
+            return (dir_entry, get_mtime(dir_entry), [])
+        except FileNotFoundError:
+            # The job dir vanished since it was listed, there is nothing to purge
+            return (dir_entry, None, [])
+    if prune_newer_than is not None:
+        older_dirs = []
+        for sub_dir in current_dirs:
+            try:
+                if get_mtime(sub_dir) < prune_newer_than:
+                    older_dirs.append(sub_dir)
+            except FileNotFoundError:
+                # The directory vanished since it was listed, there is nothing to purge
+                pass
+        current_dirs = older_dirs
+    return (dir_entry, None, current_dirs)
+
+def find_old_files(
+        log: Logger, cutoff: float, log_path: Path,
+        scan_workers: int = SCAN_WORKERS,
+        assume_monotonic_mtime: bool = False,
+        max_depth: Optional[int] = None) -> Generator[Path, None, None]:
+    """Finds old files in the log path, stopping when a directory is a jobdir
+
+    Directories are scanned concurrently by a pool of threads, so the jobdirs are
+    not yielded in a stable order. With assume_monotonic_mtime, directories more
+    recent than the cutoff timestamp are not walked. Directories more than max_depth
+    levels below the log path are not walked either.
+    """
+    debug = log.debug
+    prune_newer_than = cutoff if assume_monotonic_mtime else None
+    results: "Queue[Tuple[int, Future[ScanResult]]]" = Queue()
+    with ThreadPoolExecutor(max_workers=scan_workers) as executor:
+        def walk(dir_entry: Dir, depth: int) -> None:
+            executor.submit(scan, dir_entry, prune_newer_than).add_done_callback(
+                lambda future: results.put((depth, future)))
+
+        walk(str(log_path), 0)
+        in_flight = 1
+        while in_flight:
+            depth, future = results.get()
+            dir_entry, mtime, current_dirs = future.result()
+            in_flight -= 1
+            root = os.fspath(dir_entry)
+            if mtime is not None:
+                debug("%s : is a job dir", root)
+                if mtime < cutoff:
+                    yield Path(root)
+            elif max_depth is not None and depth >= max_depth:
+                debug("%s : max depth reached", root)
+            else:
+                debug("%s : walking", root)
+                for sub_dir in current_dirs:
+                    walk(sub_dir, depth + 1)
+                in_flight += len(current_dirs)
+
+def search_and_destroy(
+        log: Logger, calculated_time: datetime, dry_run: bool, log_path: Path,
+        scan_workers: int = SCAN_WORKERS, delete_workers: Optional[int] = None,
+        assume_monotonic_mtime: bool = False, max_depth: Optional[int] = None) -> None:
+    """Removes log dir that are older than the calcultated time
+
+    Job dirs are removed in batches by a pool of threads, the default pool size
+    being the ThreadPoolExecutor one.
+    """
+    debug = log.debug
+    root = os.fspath(log_path)
+    cutoff = calculated_time.timestamp()
+    with ThreadPoolExecutor(max_workers=delete_workers) as executor:
+        batch: List[Path] = []
+        for job_dir in find_old_files(
+                log, cutoff, log_path, scan_workers, assume_monotonic_mtime, max_depth):
+            debug("%s : removing old logs", job_dir)
+            if not dry_run and os.fspath(job_dir) != root:
+                batch.append(job_dir)
+            if len(batch) >= DELETE_BATCH_SIZE:
+                list(executor.map(delete_dir, batch))
+                batch = []
+        list(executor.map(delete_dir, batch))
+
+def positive_int(value: str) -> int:
+    """Parses a strictly positive integer argument
+
+    >>> positive_int('4')
+    4
+    >>> positive_int('0')
+    Traceback (most recent call last):
+    ...
+    argparse.ArgumentTypeError: 0 is not a positive integer
+    """
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError("%s is not a positive integer" % value)
+    return number
+
+def non_negative_int(value: str) -> int:
+    """Parses a positive or zero integer argument
+
+    >>> non_negative_int('0')
+    0
+    >>> non_negative_int('-1')
+    Traceback (most recent call last):
+    ...
+    argparse.ArgumentTypeError: -1 is not a non negative integer
+    """
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError("%s is not a non negative integer" % value)
+    return number
 
 def usage(argv: List[str]) -> argparse.Namespace:
     """The script usage
 
     >>> usage([])
-    Namespace(debug=False, dry_run=False, log_path_dir='/var/www/logs', retention_days=31)
+    Namespace(assume_monotonic_mtime=False, debug=False, delete_workers=None, dry_run=False, log_path_dir='/var/www/logs', max_depth=None, retention_days=31, scan_workers=8)
     """
     parser = argparse.ArgumentParser(description="Purge old logs")
     parser.add_argument('--dry-run', action='store_true')
     parser.add_argument('--retention-days', type=int, default=31)
     parser.add_argument('--log-path-dir', default='/var/www/logs')
+    parser.add_argument('--scan-workers', type=positive_int, default=SCAN_WORKERS)
+    parser.add_argument('--delete-workers', type=positive_int)
+    parser.add_argument('--assume-monotonic-mtime', action='store_true',
+                        help="Do not walk directories modified after the retention cut-off. "
+                        "Old job dirs below a recently modified directory are kept, e.g. "
+                        "the old builds of a periodic job, or the siblings of a job dir "
+                        "purged by the previous run")
+    parser.add_argument('--max-depth', type=non_negative_int)
     parser.add_argument('--debug', action='store_true')
     return parser.parse_args(argv)
 
@@ -111,9 +261,10 @@ def main() -> None:
     calculated_time = datetime.now() - timedelta(days=args.retention_days)
     log = setup_logging(args.debug)
     if not root:
-        log.error("The provided log path dir does not exists")
+        log.error("The provided log path dir does not exists or is not a directory")
         exit(1)
-    search_and_destroy(log, calculated_time, args.dry_run, root)
+    search_and_destroy(log, calculated_time, args.dry_run, root, args.scan_workers,
+                       args.delete_workers, args.assume_monotonic_mtime, args.max_depth)
 
 if __name__ == "__main__":
     main()
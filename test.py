@@ -14,49 +14,210 @@
 
 import logging
 import os
-import shutil
+import subprocess
 import tempfile
+import time
 import unittest
+from unittest import mock
 from contextlib import contextmanager
-from datetime import datetime, timedelta
+from datetime import datetime
 from pathlib import Path
-from typing import Callable, Generator, List, Union, NewType, Tuple
+from typing import Any, Callable, Generator, List, Optional, Union, NewType, Tuple
 
 import purgelogs
 
-yesterday = datetime.now() - timedelta(days=1)
+YESTERDAY_TS = time.time() - 24 * 3600
+YESTERDAY_NS = int(YESTERDAY_TS * 1_000_000_000)
+OLD_NS = 0
+yesterday = datetime.fromtimestamp(YESTERDAY_TS)
 
-def mkdir(path: Path) -> None:
-    path.mkdir(parents=True, exist_ok=True)
+# The trees of every test are created in a single tmpfs directory when available
+SHM = "/dev/shm"
+tests_root: Optional[str] = None
 
-def touch(path: Path, date: datetime) -> None:
-    path.touch(exist_ok=True)
-    os.utime(path, (date.timestamp(), date.timestamp()), follow_symlinks=False)
+def rm_rf(path: str) -> None:
+    subprocess.run(["rm", "-rf", "--", path], check=False)
 
-def touch_old(path: Path) -> None:
-    touch(path, datetime.fromtimestamp(0))
+def setup_module() -> None:
+    global tests_root
+    tests_root = tempfile.mkdtemp(prefix="purgelogs-", dir=SHM if os.path.isdir(SHM) else None)
+
+def teardown_module() -> None:
+    if tests_root:
+        rm_rf(tests_root)
+
+def mkdir(path: str) -> None:
+    os.makedirs(path, exist_ok=True)
+
+def set_mtime_ns(path: str, ns: int) -> None:
+    os.utime(path, ns=(ns, ns), follow_symlinks=False)
+
+def touch(path: str, ns: int) -> None:
+    if not os.path.lexists(path):
+        open(path, "a").close()
+    set_mtime_ns(path, ns)
+
+def touch_old(path: str) -> None:
+    set_mtime_ns(path, OLD_NS)
+
+def init_job(job_dir: str, ns: Optional[int] = None) -> None:
+    mkdir(f"{job_dir}/zuul-info")
+    if ns is not None:
+        set_mtime_ns(job_dir, ns)
 
 @contextmanager
-def setup_tree(tree: Callable[[Path], None]) -> Generator[Path, None, None]:
-    root = Path(tempfile.mkdtemp(prefix="purgelogs"))
+def setup_tree(tree: Callable[[str], None]) -> Generator[Path, None, None]:
+    """Builds the tree from a plain string root, and yields it as a Path for the checks"""
+    root = tempfile.mkdtemp(prefix="purgelogs", dir=tests_root)
     try:
         tree(root)
-        yield root
+        yield Path(root)
     finally:
-        shutil.rmtree(root)
+        rm_rf(root)
+
+def test_check_dir_path() -> None:
+    def tree(root: str) -> None:
+        os.symlink(f"{root}/loop", f"{root}/loop")
+        touch(f"{root}/file", OLD_NS)
+    with setup_tree(tree) as root:
+        test = unittest.TestCase()
+        test.assertEqual(purgelogs.check_dir_path(str(root)), root.resolve())
+        test.assertIsNone(purgelogs.check_dir_path(f"{root}/loop"))
+        test.assertIsNone(purgelogs.check_dir_path(f"{root}/file"))
+        test.assertIsNone(purgelogs.check_dir_path(f"{root}/missing"))
 
 def test_purge_symlink() -> None:
-    def tree(root: Path) -> None:
-        mkdir(root / "common")
-        (root / "common/current").symlink_to(root / "common")
-        touch_old(root / "common" / "current")
-        touch_old(root / "common")
-        mkdir(root / "test")
+    def tree(root: str) -> None:
+        mkdir(f"{root}/common")
+        os.symlink(f"{root}/common", f"{root}/common/current")
+        touch_old(f"{root}/common/current")
+        touch_old(f"{root}/common")
+        mkdir(f"{root}/test")
     with setup_tree(tree) as root:
         purgelogs.search_and_destroy(logging.getLogger(), yesterday, False, root)
         test = unittest.TestCase()
         test.assertTrue((root / "test").is_dir())
         test.assertFalse((root / "common").is_dir())
 
+def test_log_root_is_kept() -> None:
+    def tree(root: str) -> None:
+        touch_old(root)
+    with setup_tree(tree) as root:
+        purgelogs.search_and_destroy(logging.getLogger(), yesterday, False, root)
+        test = unittest.TestCase()
+        test.assertTrue(root.is_dir())
+
+def test_symlink_is_ignored() -> None:
+    def tree(root: str) -> None:
+        init_job(f"{root}/job", OLD_NS)
+        mkdir(f"{root}/change/logs")
+        os.symlink(f"{root}/job/zuul-info", f"{root}/change/zuul-info")
+        touch_old(f"{root}/change")
+    with setup_tree(tree) as root:
+        purgelogs.search_and_destroy(logging.getLogger(), yesterday, False, root)
+        test = unittest.TestCase()
+        test.assertFalse((root / "job").exists())
+        test.assertTrue((root / "change" / "logs").is_dir())
+
+def test_vanished_job_dir() -> None:
+    def tree(root: str) -> None:
+        init_job(f"{root}/gone", OLD_NS)
+        init_job(f"{root}/kept", OLD_NS)
+    ls = purgelogs.ls
+    def ls_then_remove(dir_path: Any) -> purgelogs.DirContent:
+        content = ls(dir_path)
+        if os.fspath(dir_path) == f"{root}/gone":
+            rm_rf(f"{root}/gone")
+        return content
+    with setup_tree(tree) as root:
+        with mock.patch.object(purgelogs, "ls", ls_then_remove):
+            purgelogs.search_and_destroy(logging.getLogger(), yesterday, False, root)
+        test = unittest.TestCase()
+        test.assertFalse((root / "gone").exists())
+        test.assertFalse((root / "kept").exists())
+
+def test_purge_nested_job_dirs() -> None:
+    def tree(root: str) -> None:
+        for change in range(10):
+            base = f"{root}/{change}"
+            init_job(f"{base}/check/zuul-old", OLD_NS)
+            init_job(f"{base}/check/zuul-recent")
+            mkdir(f"{base}/gate/jenkins-old")
+            touch(f"{base}/gate/jenkins-old/consoleText.txt", YESTERDAY_NS)
+            touch_old(f"{base}/gate/jenkins-old")
+    with setup_tree(tree) as root:
+        purgelogs.search_and_destroy(logging.getLogger(), yesterday, False, root, scan_workers=4)
+        test = unittest.TestCase()
+        for change in range(10):
+            test.assertFalse((root / str(change) / "check" / "zuul-old").exists())
+            test.assertFalse((root / str(change) / "gate" / "jenkins-old").exists())
+            test.assertTrue((root / str(change) / "check" / "zuul-recent").is_dir())
+
+def test_purge_in_batches() -> None:
+    def tree(root: str) -> None:
+        for job in range(5):
+            init_job(f"{root}/old/{job}", OLD_NS)
+            init_job(f"{root}/recent/{job}")
+    with setup_tree(tree) as root:
+        with mock.patch.object(purgelogs, "DELETE_BATCH_SIZE", 2):
+            purgelogs.search_and_destroy(logging.getLogger(), yesterday, False, root)
+        test = unittest.TestCase()
+        test.assertEqual(os.listdir(root / "old"), [])
+        test.assertEqual(len(os.listdir(root / "recent")), 5)
+
+def test_assume_monotonic_mtime() -> None:
+    def tree(root: str) -> None:
+        init_job(f"{root}/recent/job", OLD_NS)
+    for assume_monotonic_mtime in (False, True):
+        with setup_tree(tree) as root:
+            purgelogs.search_and_destroy(
+                logging.getLogger(), yesterday, False, root,
+                assume_monotonic_mtime=assume_monotonic_mtime)
+            test = unittest.TestCase()
+            test.assertEqual((root / "recent" / "job").is_dir(), assume_monotonic_mtime)
+
+def test_assume_monotonic_mtime_vanished_dir() -> None:
+    def tree(root: str) -> None:
+        init_job(f"{root}/gone/job", OLD_NS)
+        init_job(f"{root}/kept/job", OLD_NS)
+        touch_old(f"{root}/gone")
+        touch_old(f"{root}/kept")
+    ls = purgelogs.ls
+    def ls_then_remove(dir_path: Any) -> purgelogs.DirContent:
+        content = ls(dir_path)
+        if os.fspath(dir_path) == str(root):
+            rm_rf(f"{root}/gone")
+        return content
+    with setup_tree(tree) as root:
+        with mock.patch.object(purgelogs, "ls", ls_then_remove):
+            purgelogs.search_and_destroy(
+                logging.getLogger(), yesterday, False, root, assume_monotonic_mtime=True)
+        test = unittest.TestCase()
+        test.assertFalse((root / "gone").exists())
+        test.assertFalse((root / "kept" / "job").exists())
+
+def test_max_depth() -> None:
+    def tree(root: str) -> None:
+        init_job(f"{root}/shallow", OLD_NS)
+        init_job(f"{root}/too/deep", OLD_NS)
+    with setup_tree(tree) as root:
+        purgelogs.search_and_destroy(logging.getLogger(), yesterday, False, root, max_depth=1)
+        test = unittest.TestCase()
+        test.assertFalse((root / "shallow").exists())
+        test.assertTrue((root / "too" / "deep").is_dir())
+
+def test_skip_dirs() -> None:
+    def tree(root: str) -> None:
+        mkdir(f"{root}/project/.git/refs")
+        touch_old(f"{root}/project/.git/refs")
+        mkdir(f"{root}/volume/lost+found")
+        touch_old(f"{root}/volume/lost+found")
+        touch_old(f"{root}/volume")
+    with setup_tree(tree) as root:
+        purgelogs.search_and_destroy(logging.getLogger(), yesterday, False, root)
+        test = unittest.TestCase()
+        test.assertTrue((root / "project" / ".git" / "refs").is_dir())
+        test.assertTrue((root / "volume" / "lost+found").is_dir())
+
 if __name__ == '__main__':
     unittest.main()